@@ -2,9 +2,9 @@
 LazyAuth - Simple OAuth2 Authentication System
 """
 
-from .auth import router as auth_router
+from .auth import router as auth_router, close_clients
 from .config import settings
 from .models import User, Token
 
 __version__ = "0.1.0"
-__all__ = ["auth_router", "settings", "User", "Token"]
+__all__ = ["auth_router", "close_clients", "settings", "User", "Token"]
@@ -2,99 +2,331 @@
 OAuth2 authentication implementation
 """
 
+import asyncio
+import hashlib
+import heapq
 import secrets
-from datetime import datetime, timedelta, timezone
+import threading
+import time
 from typing import Optional, Dict, Any
 from urllib.parse import urlencode
 
 import httpx
+import jwt
+import redis.asyncio as redis
+from cachetools import TTLCache
 from fastapi import APIRouter, HTTPException, Request, Response, Depends
 from fastapi.responses import RedirectResponse, JSONResponse
-from jose import JWTError, jwt
+from jwt import PyJWTError
+from redis.exceptions import RedisError
 
 from .config import settings
+from .jwks import CachedJWKS
 from .models import User, Token, OAuth2Token
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
-# In-memory session storage (for demo purposes)
-# In production, use Redis or similar
+# JWT settings bound once at import (settings do not change at runtime)
+_JWT_ALG = settings.jwt_algorithm
+_JWT_ALGORITHMS = [_JWT_ALG]
+_JWT_EXP_SEC = settings.jwt_expiration_minutes * 60
+
+# Signing key prepared once per process (str -> bytes plus PyJWT's key
+# checks) so a misconfigured secret fails at import, not on first request
+_SIGNING_KEY = jwt.get_algorithm_by_name(_JWT_ALG).prepare_key(
+    settings.jwt_secret_key
+)
+
+# Authorization URL up to the state parameter, which is the only part that
+# varies per login (token_urlsafe output needs no further quoting)
+_AUTH_URL_PREFIX = f"{settings.oauth2_authorization_url}?" + urlencode({
+    "client_id": settings.oauth2_client_id,
+    "redirect_uri": settings.oauth2_redirect_uri,
+    "response_type": "code",
+    "scope": "openid profile email"
+}) + "&state="
+
+# Static fields of the authorization code exchange; only "code" varies
+_TOKEN_REQUEST_DATA = {
+    "grant_type": "authorization_code",
+    "redirect_uri": settings.oauth2_redirect_uri,
+    "client_id": settings.oauth2_client_id,
+    "client_secret": settings.oauth2_client_secret,
+}
+
+# Set-Cookie header that expires the access_token cookie; constant, so it
+# is built once instead of through SimpleCookie on every logout
+_LOGOUT_COOKIE = (
+    b"access_token=; Path=/; Max-Age=0; HttpOnly; SameSite=lax; Secure"
+)
+
+# OAuth2 state storage. Uses Redis when REDIS_URL is configured, otherwise
+# falls back to in-memory storage (for demo purposes)
 # Sessions expire after 10 minutes
-sessions: Dict[str, tuple[str, datetime]] = {}
+SESSION_TTL_SECONDS = 600
+_redis: Optional[redis.Redis] = None
+# Maps state -> absolute expiry on the time.monotonic() clock
+sessions: Dict[str, float] = {}
+# Min-heap of (expiry, state) so cleanup only touches expired states
+_expiry_heap: list[tuple[float, str]] = []
+# Cleanup runs at most once per interval instead of on every login
+SESSION_CLEANUP_INTERVAL_SECONDS = 60
+SESSION_CLEANUP_BATCH_SIZE = 20
+_last_cleanup: float = 0.0
+_cleanup_task: Optional[asyncio.Task] = None
+
+# Shared HTTP client so connections (and TLS sessions) to the OAuth2
+# provider are reused across callbacks. Created on first use and reset by
+# close_clients(), so a later application lifespan gets a fresh client.
+_http: Optional[httpx.AsyncClient] = None
+
+# Token/protocol claims of an id_token that are not user profile data
+_ID_TOKEN_PROTOCOL_CLAIMS = frozenset({
+    "iss", "aud", "exp", "nbf", "iat", "jti", "nonce", "auth_time",
+    "acr", "amr", "azp", "at_hash", "c_hash", "sid"
+})
+
+# Provider signing keys for id_token verification (only if configured).
+# The HTTP client is looked up per fetch since it may be recreated.
+_jwks = (
+    CachedJWKS(settings.oauth2_jwks_url, lambda: get_http_client())
+    if settings.oauth2_jwks_url else None
+)
+
+# Cache of verified tokens, keyed by SHA-256 of the token (raw tokens are
+# never stored). Values are (user, exp) so expiry can be re-checked on hit.
+_verify_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+_verify_cache_lock = threading.Lock()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it if needed"""
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            http2=True,
+            timeout=5.0,
+            limits=httpx.Limits(max_keepalive_connections=32)
+        )
+    return _http
+
+
+def get_redis_client() -> Optional[redis.Redis]:
+    """Return the shared Redis client, or None when REDIS_URL is not set"""
+    global _redis
+    if _redis is None and settings.redis_url:
+        _redis = redis.from_url(settings.redis_url)
+    return _redis
+
+
+async def close_clients():
+    """Close shared HTTP and Redis clients (call on application shutdown)"""
+    global _http, _redis
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
 
+def cleanup_expired_sessions(limit: Optional[int] = None) -> int:
+    """Remove expired sessions from memory, returning how many were removed"""
+    now = time.monotonic()
+    removed = 0
+    while _expiry_heap and _expiry_heap[0][0] < now:
+        if limit is not None and removed >= limit:
+            break
+        _, state = heapq.heappop(_expiry_heap)
+        sessions.pop(state, None)
+        removed += 1
+    return removed
 
-def cleanup_expired_sessions():
-    """Remove expired sessions from memory"""
-    current_time = datetime.now(timezone.utc)
-    expired = [
-        state for state, (status, timestamp) in sessions.items()
-        if (current_time - timestamp).total_seconds() > 600  # 10 minutes
-    ]
-    for state in expired:
-        del sessions[state]
+
+async def _cleanup_async():
+    """Remove expired sessions in small batches, yielding to the event loop"""
+    while cleanup_expired_sessions(limit=SESSION_CLEANUP_BATCH_SIZE):
+        await asyncio.sleep(0)
+
+
+def _schedule_cleanup():
+    """Start a background cleanup if the interval has elapsed"""
+    global _last_cleanup, _cleanup_task
+    now = time.monotonic()
+    if now - _last_cleanup <= SESSION_CLEANUP_INTERVAL_SECONDS:
+        return
+    if _cleanup_task is not None and not _cleanup_task.done():
+        return
+    _last_cleanup = now
+    _cleanup_task = asyncio.create_task(_cleanup_async())
+
+
+async def store_session_state(state: str) -> None:
+    """Store a pending OAuth2 state until it is used or expires"""
+    redis_client = get_redis_client()
+    if redis_client is not None:
+        # Redis expires the key itself, no cleanup pass needed
+        try:
+            await redis_client.set(
+                f"sess:{state}", "pending", ex=SESSION_TTL_SECONDS
+            )
+        except RedisError as e:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Session store unavailable: {str(e)}"
+            )
+        return
+    
+    _schedule_cleanup()
+    expires_at = time.monotonic() + SESSION_TTL_SECONDS
+    sessions[state] = expires_at
+    heapq.heappush(_expiry_heap, (expires_at, state))
+
+
+async def consume_session_state(state: str) -> bool:
+    """Remove a pending OAuth2 state, returning whether it existed"""
+    redis_client = get_redis_client()
+    if redis_client is not None:
+        # Check-and-delete in a single atomic round trip
+        try:
+            return bool(await redis_client.delete(f"sess:{state}"))
+        except RedisError as e:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Session store unavailable: {str(e)}"
+            )
+    
+    # Cleanup is periodic, so reject states that expired but are still stored
+    expires_at = sessions.pop(state, None)
+    return expires_at is not None and expires_at > time.monotonic()
 
 
 def create_jwt_token(user: User) -> Token:
     """Create JWT token for authenticated user"""
-    expires_delta = timedelta(minutes=settings.jwt_expiration_minutes)
-    expire = datetime.now(timezone.utc) + expires_delta
-    
     to_encode = {
         "sub": user.id,
         "email": user.email,
         "name": user.name,
         "provider": user.provider,
-        "exp": expire
+        "exp": int(time.time()) + _JWT_EXP_SEC
     }
     
     encoded_jwt = jwt.encode(
         to_encode,
-        settings.jwt_secret_key,
-        algorithm=settings.jwt_algorithm
+        _SIGNING_KEY,
+        algorithm=_JWT_ALG
     )
     
     return Token(
         access_token=encoded_jwt,
         token_type="bearer",
-        expires_in=settings.jwt_expiration_minutes * 60
+        expires_in=_JWT_EXP_SEC
     )
 
 
 def verify_jwt_token(token: str) -> Optional[User]:
-    """Verify JWT token and return user data"""
+    """Verify JWT token and return user data
+    
+    Repeated calls with the same token may return the same cached User
+    instance, so treat it as read-only (use model_copy() to modify it).
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+    if cached is not None:
+        user, exp = cached
+        if exp > time.time():
+            return user
+        with _verify_cache_lock:
+            _verify_cache.pop(key, None)
+        return None
+    
     try:
+        # Signature, exp and presence of sub/exp are all checked in one pass
         payload = jwt.decode(
             token,
-            settings.jwt_secret_key,
-            algorithms=[settings.jwt_algorithm]
+            _SIGNING_KEY,
+            algorithms=_JWT_ALGORITHMS,
+            options={"require": ["sub", "exp"], "verify_exp": True}
         )
-        
-        user_id: str = payload.get("sub")
-        if user_id is None:
+    except PyJWTError:
+        return None
+    
+    # Payload is from our own signed token, so skip Pydantic validation
+    user = User.model_construct(
+        id=payload["sub"],
+        email=payload.get("email"),
+        name=payload.get("name"),
+        provider=payload.get("provider", "unknown"),
+        provider_data={}
+    )
+    
+    with _verify_cache_lock:
+        _verify_cache[key] = (user, payload["exp"])
+    
+    return user
+
+
+def read_id_token_claims(id_token: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Read user claims from a provider id_token, if one was returned"""
+    if not id_token:
+        return None
+    try:
+        # The id_token comes straight from the token endpoint over TLS, which
+        # may stand in for the signature check only (OIDC Core 3.1.3.7);
+        # aud, exp and (when configured) iss are still validated
+        return jwt.decode(
+            id_token,
+            audience=settings.oauth2_client_id,
+            issuer=settings.oauth2_issuer or None,
+            options={
+                "verify_signature": False,
+                "verify_aud": True,
+                "verify_exp": True,
+                "verify_iss": bool(settings.oauth2_issuer)
+            }
+        )
+    except PyJWTError:
+        return None
+
+
+async def verify_provider_id_token(id_token: str) -> Optional[Dict[str, Any]]:
+    """Verify a provider id_token against the cached JWKS and return its claims
+    
+    Returns None on any verification or JWKS fetch failure, so the caller
+    can fall back to the user info endpoint.
+    """
+    try:
+        header = jwt.get_unverified_header(id_token)
+        jwk = await _jwks.get_key(header.get("kid"))
+        if jwk is None:
             return None
-            
-        return User(
-            id=user_id,
-            email=payload.get("email"),
-            name=payload.get("name"),
-            provider=payload.get("provider", "unknown")
+        # Only accept the algorithm the key itself is for, never the header's
+        return jwt.decode(
+            id_token,
+            jwk.key,
+            algorithms=[jwk.algorithm_name],
+            audience=settings.oauth2_client_id,
+            issuer=settings.oauth2_issuer,
+            options={"require": ["exp", "iat", "iss", "sub"]}
         )
-    except JWTError:
+    except (PyJWTError, httpx.HTTPError, ValueError, TypeError):
         return None
 
 
-async def get_current_user(request: Request) -> User:
-    """Dependency to get current authenticated user"""
-    # Check Authorization header
+def get_request_token(request: Request) -> Optional[str]:
+    """Return the Bearer token from the Authorization header, else the cookie"""
     auth_header = request.headers.get("Authorization")
     if auth_header and auth_header.startswith("Bearer "):
-        token = auth_header.replace("Bearer ", "")
-        user = verify_jwt_token(token)
-        if user:
-            return user
-    
-    # Check cookie
-    token = request.cookies.get("access_token")
+        return auth_header.removeprefix("Bearer ")
+    return request.cookies.get("access_token")
+
+
+async def get_current_user(request: Request) -> User:
+    """Dependency to get current authenticated user"""
+    # Verify whichever token was found exactly once
+    token = get_request_token(request)
     if token:
         user = verify_jwt_token(token)
         if user:
@@ -106,23 +338,12 @@ async def get_current_user(request: Request) -> User:
 @router.get("/login")
 async def login():
     """Initiate OAuth2 login flow"""
-    # Clean up expired sessions
-    cleanup_expired_sessions()
-    
     # Generate random state for CSRF protection
-    state = secrets.token_urlsafe(32)
-    sessions[state] = ("pending", datetime.now(timezone.utc))
+    state = secrets.token_urlsafe(16)  # 128 bits
+    await store_session_state(state)
     
     # Build authorization URL
-    params = {
-        "client_id": settings.oauth2_client_id,
-        "redirect_uri": settings.oauth2_redirect_uri,
-        "response_type": "code",
-        "state": state,
-        "scope": "openid profile email"
-    }
-    
-    auth_url = f"{settings.oauth2_authorization_url}?{urlencode(params)}"
+    auth_url = _AUTH_URL_PREFIX + state
     
     return {
         "authorization_url": auth_url,
@@ -134,43 +355,49 @@ async def login():
 @router.get("/callback")
 async def auth_callback(code: str, state: str, response: Response):
     """Handle OAuth2 callback"""
-    # Verify state to prevent CSRF
-    if state not in sessions:
+    # Verify and remove used state to prevent CSRF
+    if not await consume_session_state(state):
         raise HTTPException(status_code=400, detail="Invalid state parameter")
     
-    # Remove used state
-    del sessions[state]
-    
     # Exchange authorization code for access token
-    async with httpx.AsyncClient() as client:
-        try:
-            token_response = await client.post(
-                settings.oauth2_token_url,
-                data={
-                    "grant_type": "authorization_code",
-                    "code": code,
-                    "redirect_uri": settings.oauth2_redirect_uri,
-                    "client_id": settings.oauth2_client_id,
-                    "client_secret": settings.oauth2_client_secret,
-                }
-            )
-            token_response.raise_for_status()
-            token_data = token_response.json()
-            oauth_token = OAuth2Token(**token_data)
-            
-            # Get user info from provider
-            user_info_response = await client.get(
+    try:
+        http = get_http_client()
+        token_response = await http.post(
+            settings.oauth2_token_url,
+            data={**_TOKEN_REQUEST_DATA, "code": code}
+        )
+        token_response.raise_for_status()
+        token_data = token_response.json()
+        oauth_token = OAuth2Token(**token_data)
+        
+        # OIDC providers embed the user claims in the id_token, which saves
+        # a round trip to the user info endpoint (opt-in, see README)
+        user_data = None
+        if settings.oauth2_use_id_token and oauth_token.id_token:
+            if _jwks is not None:
+                user_data = await verify_provider_id_token(oauth_token.id_token)
+            else:
+                user_data = read_id_token_claims(oauth_token.id_token)
+        provider_data: Dict[str, Any] = {
+            claim: value for claim, value in (user_data or {}).items()
+            if claim not in _ID_TOKEN_PROTOCOL_CLAIMS
+        }
+        
+        # Get user info from provider when the id_token is missing, invalid
+        # or only carries the subject
+        if user_data is None or not user_data.get("email"):
+            user_info_response = await http.get(
                 settings.oauth2_user_info_url,
                 headers={"Authorization": f"Bearer {oauth_token.access_token}"}
             )
             user_info_response.raise_for_status()
-            user_data = user_info_response.json()
-            
-        except httpx.HTTPError as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to authenticate with provider: {str(e)}"
-            )
+            user_data = provider_data = user_info_response.json()
+        
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to authenticate with provider: {str(e)}"
+        )
     
     # Create user object from provider data
     user = User(
@@ -178,7 +405,7 @@ async def auth_callback(code: str, state: str, response: Response):
         email=user_data.get("email"),
         name=user_data.get("name") or user_data.get("display_name"),
         provider="oauth2",
-        provider_data=user_data
+        provider_data=provider_data
     )
     
     # Create JWT token for our application
@@ -210,21 +437,17 @@ async def get_user_profile(current_user: User = Depends(get_current_user)):
 @router.post("/logout")
 async def logout(response: Response):
     """Logout user"""
-    response.delete_cookie("access_token")
+    response.raw_headers.append((b"set-cookie", _LOGOUT_COOKIE))
     return {"message": "Logged out successfully"}
 
 
 @router.get("/status")
 async def auth_status(request: Request):
     """Check authentication status"""
-    try:
-        user = await get_current_user(request)
-        return {
-            "authenticated": True,
-            "user": user
-        }
-    except HTTPException:
-        return {
-            "authenticated": False,
-            "user": None
-        }
+    # Avoid raising/catching HTTPException for the common logged-out case
+    token = get_request_token(request)
+    user = verify_jwt_token(token) if token else None
+    return {
+        "authenticated": user is not None,
+        "user": user
+    }
@@ -21,12 +21,22 @@ class Settings(BaseSettings):
     oauth2_token_url: str = os.getenv("OAUTH2_TOKEN_URL", "")
     oauth2_user_info_url: str = os.getenv("OAUTH2_USER_INFO_URL", "")
     oauth2_redirect_uri: str = os.getenv("OAUTH2_REDIRECT_URI", "http://localhost:8000/auth/callback")
+    # Read user claims from the provider id_token instead of the user info
+    # endpoint (off by default: User.id becomes the id_token "sub")
+    oauth2_use_id_token: bool = os.getenv("OAUTH2_USE_ID_TOKEN", "false").lower() in ("1", "true", "yes")
+    # Provider JWKS URL; when set, id_tokens are signature-verified
+    oauth2_jwks_url: str = os.getenv("OAUTH2_JWKS_URL", "")
+    # Expected id_token issuer ("iss"); required for JWKS verification
+    oauth2_issuer: str = os.getenv("OAUTH2_ISSUER", "")
     
     # JWT Configuration
     jwt_secret_key: str = os.getenv("JWT_SECRET_KEY", "default-secret-key-change-in-production")
     jwt_algorithm: str = os.getenv("JWT_ALGORITHM", "HS256")
     jwt_expiration_minutes: int = int(os.getenv("JWT_EXPIRATION_MINUTES", "30"))
     
+    # Session Storage (leave empty to keep OAuth2 states in memory)
+    redis_url: str = os.getenv("REDIS_URL", "")
+    
     # Application Configuration
     app_host: str = os.getenv("APP_HOST", "0.0.0.0")
     app_port: int = int(os.getenv("APP_PORT", "8000"))
@@ -44,6 +54,16 @@ class Settings(BaseSettings):
                 UserWarning,
                 stacklevel=2
             )
+        # JWKS verification checks "iss", so it rejects every id_token
+        # when no issuer is configured
+        if self.oauth2_jwks_url and not self.oauth2_issuer:
+            warnings.warn(
+                "OAUTH2_JWKS_URL is set without OAUTH2_ISSUER! Every provider "
+                "id_token will fail verification. "
+                "Please set OAUTH2_ISSUER in your .env file.",
+                UserWarning,
+                stacklevel=2
+            )
 
 
 settings = Settings()
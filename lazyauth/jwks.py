@@ -0,0 +1,101 @@
+"""
+Cached JWKS fetching for OAuth2 provider id_token verification
+"""
+
+import asyncio
+import time
+from typing import Callable, Dict, Optional
+
+import httpx
+from jwt import PyJWK, PyJWKSet, PyJWKSetError
+
+
+class CachedJWKS:
+    """Provider signing keys fetched from a JWKS URL and cached by kid"""
+
+    def __init__(
+        self,
+        fetch_url: str,
+        http: Callable[[], httpx.AsyncClient],
+        ttl_s: int = 300,
+        min_refresh_s: int = 10,
+        retry_s: int = 30
+    ):
+        self.fetch_url = fetch_url
+        self.ttl_s = ttl_s
+        self.min_refresh_s = min_refresh_s
+        self.retry_s = retry_s
+        # Called per fetch so a recreated shared client is picked up
+        self._http = http
+        # Parsed keys, so PEM/JWK parsing happens once per refresh
+        self._keys: Dict[str, PyJWK] = {}
+        self._fetched_at: Optional[float] = None
+        # Last fetch attempt, successful or not, for throttling refreshes
+        self._attempted_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._revalidate_task: Optional[asyncio.Task] = None
+
+    def _age(self) -> float:
+        """Seconds since the last successful fetch"""
+        if self._fetched_at is None:
+            return float("inf")
+        return time.monotonic() - self._fetched_at
+
+    def _since_attempt(self) -> float:
+        """Seconds since the last fetch attempt"""
+        if self._attempted_at is None:
+            return float("inf")
+        return time.monotonic() - self._attempted_at
+
+    async def refresh(self) -> None:
+        """Fetch the JWKS and replace the cached keys"""
+        async with self._lock:
+            # Another request may have tried while we waited for the lock;
+            # a failed attempt counts too, so a down provider isn't hammered
+            if self._since_attempt() < self.min_refresh_s:
+                return
+            self._attempted_at = time.monotonic()
+            response = await self._http().get(self.fetch_url)
+            response.raise_for_status()
+            data = response.json()
+            if not isinstance(data, dict):
+                raise PyJWKSetError("JWKS response is not a JSON object")
+            jwk_set = PyJWKSet.from_dict(data)
+            self._keys = {
+                jwk.key_id: jwk for jwk in jwk_set.keys if jwk.key_id
+            }
+            self._fetched_at = time.monotonic()
+
+    async def _revalidate(self) -> None:
+        """Retry a failed refresh in the background"""
+        await asyncio.sleep(self.retry_s)
+        try:
+            await self.refresh()
+        except (httpx.HTTPError, ValueError, PyJWKSetError):
+            # Keep serving the stale keys; the next lookup retries again
+            pass
+
+    async def get_key(self, kid: Optional[str]) -> Optional[PyJWK]:
+        """Return the key for kid, refreshing the JWKS if needed"""
+        key = self._keys.get(kid) if kid else None
+        if key is not None and self._age() < self.ttl_s:
+            return key
+
+        # Serve the stale key while a background refresh is pending
+        if key is not None and self._revalidate_task is not None \
+                and not self._revalidate_task.done():
+            return key
+
+        # Unknown kid right after a refresh attempt: don't hammer the provider
+        if key is None and self._since_attempt() < self.min_refresh_s:
+            return None
+
+        try:
+            await self.refresh()
+        except (httpx.HTTPError, ValueError, PyJWKSetError):
+            if key is None:
+                raise
+            self._revalidate_task = asyncio.create_task(self._revalidate())
+            return key
+
+        return self._keys.get(kid) if kid else None
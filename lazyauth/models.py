@@ -29,3 +29,4 @@ class OAuth2Token(BaseModel):
     expires_in: Optional[int] = None
     refresh_token: Optional[str] = None
     scope: Optional[str] = None
+    id_token: Optional[str] = None
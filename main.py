@@ -2,27 +2,38 @@
 Example FastAPI application using LazyAuth
 """
 
-from fastapi import FastAPI, Depends
-from fastapi.responses import HTMLResponse
+import gzip
+from contextlib import asynccontextmanager
 
-from lazyauth import auth_router, settings
+from fastapi import FastAPI, Depends, Request, Response
+from fastapi.responses import HTMLResponse, ORJSONResponse
+
+from lazyauth import auth_router, close_clients, settings
 from lazyauth.auth import get_current_user
 from lazyauth.models import User
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Close LazyAuth's shared clients on shutdown"""
+    yield
+    await close_clients()
+
+
 app = FastAPI(
     title="LazyAuth Example",
     description="Simple OAuth2 Authentication System",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Include authentication routes
 app.include_router(auth_router)
 
 
-@app.get("/", response_class=HTMLResponse)
-async def home():
-    """Home page with login button"""
-    html_content = """
+# Home page is static, so encode (and gzip) it once at import
+_HOME_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -189,7 +200,42 @@ async def home():
     </body>
     </html>
     """
-    return html_content
+_HOME_BYTES: bytes = _HOME_HTML.encode("utf-8")
+_HOME_GZ: bytes = gzip.compress(_HOME_BYTES, 9)
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip, honouring q-values"""
+    qvalues = {}
+    for coding in accept_encoding.split(","):
+        name, *params = coding.split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.strip().lower()] = q
+    # An explicit gzip entry takes precedence over the "*" wildcard
+    return qvalues.get("gzip", qvalues.get("*", 0.0)) > 0
+
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
+    """Home page with login button"""
+    if accepts_gzip(request.headers.get("Accept-Encoding", "")):
+        return Response(
+            content=_HOME_GZ,
+            media_type="text/html",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        )
+    return Response(
+        content=_HOME_BYTES,
+        media_type="text/html",
+        headers={"Vary": "Accept-Encoding"}
+    )
 
 
 @app.get("/protected")
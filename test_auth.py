@@ -2,11 +2,96 @@
 Simple tests for LazyAuth authentication system
 """
 
+import asyncio
+import hashlib
+import time
+import warnings
+from unittest.mock import patch
+
+import httpx
+import jwt
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jwt.algorithms import ECAlgorithm, RSAAlgorithm
+from redis.exceptions import ConnectionError as RedisConnectionError
 from fastapi.testclient import TestClient
 from main import app
+from lazyauth import auth
+from lazyauth.auth import create_jwt_token, verify_jwt_token
+from lazyauth.config import Settings
+from lazyauth.jwks import CachedJWKS
+from lazyauth.models import User
 
 client = TestClient(app)
 
+PROVIDER_ISSUER = "https://provider.test"
+PROVIDER_CLIENT_ID = "client-1"
+PROVIDER_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def provider_id_token(key=PROVIDER_KEY, algorithm="RS256", kid="k1", **claims):
+    """Build a provider id_token; pass a claim as None to leave it out"""
+    now = int(time.time())
+    payload = {
+        "iss": PROVIDER_ISSUER,
+        "aud": PROVIDER_CLIENT_ID,
+        "sub": "provider-user",
+        "iat": now,
+        "exp": now + 300,
+        "email": "user@provider.test",
+        "name": "Provider User",
+    }
+    payload.update(claims)
+    payload = {k: v for k, v in payload.items() if v is not None}
+    return jwt.encode(payload, key, algorithm=algorithm, headers={"kid": kid})
+
+
+def provider_jwks(public_key=None, kid="k1"):
+    """JWKS body publishing the provider's RSA key (or another key)"""
+    public_key = public_key or PROVIDER_KEY.public_key()
+    algorithm = RSAAlgorithm if isinstance(public_key, rsa.RSAPublicKey) else ECAlgorithm
+    return {"keys": [{**algorithm.to_jwk(public_key, as_dict=True), "kid": kid}]}
+
+
+def provider_settings():
+    """Patch the provider endpoints, client id and issuer"""
+    return patch.multiple(
+        auth.settings,
+        oauth2_client_id=PROVIDER_CLIENT_ID,
+        oauth2_issuer=PROVIDER_ISSUER,
+        oauth2_token_url=f"{PROVIDER_ISSUER}/token",
+        oauth2_user_info_url=f"{PROVIDER_ISSUER}/userinfo"
+    )
+
+
+def run_callback(id_token=None, jwks=None, use_id_token=True):
+    """Log in and complete the callback against a mocked provider"""
+    calls = []
+    
+    def handler(request):
+        calls.append(request.url.path)
+        if request.url.path == "/token":
+            body = {"access_token": "provider-access", "token_type": "bearer"}
+            if id_token:
+                body["id_token"] = id_token
+            return httpx.Response(200, json=body)
+        if request.url.path == "/jwks":
+            return httpx.Response(200, json=jwks)
+        return httpx.Response(200, json={
+            "id": "info-user", "email": "info@provider.test", "name": "Info User"
+        })
+    
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    cached_jwks = (
+        auth.CachedJWKS(f"{PROVIDER_ISSUER}/jwks", lambda: http) if jwks else None
+    )
+    with provider_settings(), patch.object(auth, "_http", http), \
+            patch.object(auth, "_jwks", cached_jwks), \
+            patch.object(auth.settings, "oauth2_use_id_token", use_id_token):
+        state = client.get("/auth/login").json()["state"]
+        response = client.get(f"/auth/callback?code=abc&state={state}")
+    assert response.status_code == 200
+    return response.json()["user"], calls
+
 
 def test_health_check():
     """Test health check endpoint"""
@@ -26,6 +111,19 @@ def test_home_page():
     print("✅ Home page test passed")
 
 
+def test_home_page_respects_gzip_qvalue():
+    """Test that gzip is only used when the client accepts it"""
+    response = client.get("/", headers={"Accept-Encoding": "gzip;q=0, identity"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert "LazyAuth" in response.text
+    
+    response = client.get("/", headers={"Accept-Encoding": "deflate, gzip;q=0.5"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "LazyAuth" in response.text
+    print("✅ Home page gzip negotiation test passed")
+
+
 def test_login_endpoint():
     """Test login endpoint returns authorization URL"""
     response = client.get("/auth/login")
@@ -63,12 +161,340 @@ def test_me_endpoint_requires_auth():
     print("✅ Me endpoint authorization test passed")
 
 
+def test_me_endpoint_with_bearer_token():
+    """Test that a valid Bearer token is accepted even with a bad cookie"""
+    user = User(id="user-1", email="user@example.com", name="User", provider="oauth2")
+    token = create_jwt_token(user)
+    response = client.get(
+        "/auth/me",
+        headers={
+            "Authorization": f"Bearer {token.access_token}",
+            "Cookie": "access_token=invalid"
+        }
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["id"] == "user-1"
+    assert data["email"] == "user@example.com"
+    print("✅ Me endpoint (Bearer token) test passed")
+
+
+def test_verified_user_is_cached():
+    """Test that verifying the same token twice returns the cached User"""
+    user = User(id="user-2", provider="oauth2")
+    token = create_jwt_token(user)
+    first = verify_jwt_token(token.access_token)
+    assert first is not None
+    assert first.id == "user-2"
+    assert verify_jwt_token(token.access_token) is first
+    print("✅ Verified user cache test passed")
+
+
+def test_cached_user_expires_with_token():
+    """Test that a cache hit re-checks exp so tokens cannot outlive it"""
+    token = create_jwt_token(User(id="user-3", provider="oauth2")).access_token
+    assert verify_jwt_token(token) is not None
+    key = hashlib.sha256(token.encode()).digest()
+    assert key in auth._verify_cache
+    
+    exp = jwt.decode(token, options={"verify_signature": False})["exp"]
+    with patch.object(auth.time, "time", return_value=exp + 1):
+        assert verify_jwt_token(token) is None
+    assert key not in auth._verify_cache
+    print("✅ Cached user expiry test passed")
+
+
+def test_jwks_keys_are_cached():
+    """Test that JWKS keys are fetched once and served stale on provider errors"""
+    calls = []
+    responses = [
+        httpx.Response(200, json={"keys": [
+            {"kty": "oct", "kid": "k1", "alg": "HS256", "k": "c2VjcmV0"}
+        ]}),
+        httpx.Response(503),
+    ]
+    
+    def handler(request):
+        calls.append(request)
+        return responses[len(calls) - 1]
+    
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http:
+            jwks = CachedJWKS("https://provider.test/jwks", lambda: http)
+            first = await jwks.get_key("k1")
+            assert first.key == b"secret"
+            assert await jwks.get_key("k1") is first
+            assert len(calls) == 1
+            
+            # Expired cache + provider error: the stale key is still served
+            jwks.ttl_s = jwks.min_refresh_s = 0
+            assert await jwks.get_key("k1") is first
+            assert len(calls) == 2
+            
+            # Same for a JWKS body that is JSON but not an object
+            jwks._revalidate_task = None
+            responses.append(httpx.Response(200, json=[1, 2]))
+            assert await jwks.get_key("k1") is first
+            assert len(calls) == 3
+    
+    asyncio.run(run())
+    print("✅ JWKS cache test passed")
+
+
+def test_jwks_refresh_is_throttled_while_provider_down():
+    """Test that failed JWKS fetches also throttle unknown-kid refreshes"""
+    calls = []
+    
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503)
+    
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http:
+            jwks = CachedJWKS("https://provider.test/jwks", lambda: http)
+            try:
+                await jwks.get_key("unknown")
+                assert False, "expected the failed fetch to raise"
+            except httpx.HTTPStatusError:
+                pass
+            for _ in range(3):
+                assert await jwks.get_key("unknown") is None
+            assert len(calls) == 1
+    
+    asyncio.run(run())
+    print("✅ JWKS refresh throttle test passed")
+
+
+def test_verify_provider_id_token():
+    """Test id_token verification against the JWKS and its failure modes"""
+    def verify(id_token, handler):
+        async def run():
+            transport = httpx.MockTransport(handler)
+            async with httpx.AsyncClient(transport=transport) as http:
+                jwks = auth.CachedJWKS("https://provider.test/jwks", lambda: http)
+                with patch.object(auth, "_jwks", jwks):
+                    return await auth.verify_provider_id_token(id_token)
+        return asyncio.run(run())
+    
+    def jwks_response(**kwargs):
+        return lambda request: httpx.Response(200, json=provider_jwks(**kwargs))
+    
+    with provider_settings():
+        claims = verify(provider_id_token(), jwks_response())
+        assert claims["sub"] == "provider-user"
+        
+        # Missing required claims and a foreign issuer are rejected
+        assert verify(provider_id_token(exp=None), jwks_response()) is None
+        assert verify(provider_id_token(iat=None), jwks_response()) is None
+        assert verify(provider_id_token(iss="https://evil.example"), jwks_response()) is None
+        assert verify(provider_id_token(aud="other-client"), jwks_response()) is None
+        
+        # Key type that does not match the token's alg
+        ec_key = ec.generate_private_key(ec.SECP256R1()).public_key()
+        assert verify(provider_id_token(), jwks_response(public_key=ec_key)) is None
+        
+        # Unknown kid while the JWKS fetch fails, and a non-JSON JWKS body
+        assert verify(provider_id_token(kid="k2"), lambda r: httpx.Response(503)) is None
+        assert verify(
+            provider_id_token(), lambda r: httpx.Response(200, text="<html>")
+        ) is None
+        assert verify(
+            provider_id_token(), lambda r: httpx.Response(200, json=[1, 2])
+        ) is None
+    print("✅ Provider id_token verification test passed")
+
+
+def test_callback_with_id_token():
+    """Test that id_token claims replace the user info request"""
+    user, calls = run_callback(id_token=provider_id_token())
+    assert calls == ["/token"]
+    assert user["id"] == "provider-user"
+    assert user["email"] == "user@provider.test"
+    assert user["provider_data"] == {
+        "sub": "provider-user",
+        "email": "user@provider.test",
+        "name": "Provider User"
+    }
+    
+    # An id_token with only the subject still needs the user info request
+    user, calls = run_callback(id_token=provider_id_token(email=None, name=None))
+    assert calls == ["/token", "/userinfo"]
+    assert user["email"] == "info@provider.test"
+    
+    # Without a signature check, aud and exp are still validated
+    for id_token in (
+        provider_id_token(aud="other-client"),
+        provider_id_token(exp=int(time.time()) - 60)
+    ):
+        user, calls = run_callback(id_token=id_token)
+        assert calls == ["/token", "/userinfo"]
+        assert user["id"] == "info-user"
+    print("✅ Callback (id_token) test passed")
+
+
+def test_callback_ignores_id_token_by_default():
+    """Test that the id_token is only used when OAUTH2_USE_ID_TOKEN is set"""
+    user, calls = run_callback(id_token=provider_id_token(), use_id_token=False)
+    assert calls == ["/token", "/userinfo"]
+    assert user["id"] == "info-user"
+    assert user["provider_data"]["id"] == "info-user"
+    print("✅ Callback (id_token disabled) test passed")
+
+
+def test_callback_without_id_token():
+    """Test that the user info endpoint is used without an id_token"""
+    user, calls = run_callback()
+    assert calls == ["/token", "/userinfo"]
+    assert user["id"] == "info-user"
+    assert user["provider_data"]["email"] == "info@provider.test"
+    print("✅ Callback (user info) test passed")
+
+
+def test_callback_with_unverifiable_id_token():
+    """Test that an id_token failing JWKS verification falls back to user info"""
+    id_token = provider_id_token(iss="https://evil.example")
+    user, calls = run_callback(id_token=id_token, jwks=provider_jwks())
+    assert calls == ["/token", "/jwks", "/userinfo"]
+    assert user["id"] == "info-user"
+    print("✅ Callback (unverifiable id_token) test passed")
+
+
+def after_session_ttl():
+    """Patch time.monotonic to just past the session TTL"""
+    real_monotonic = time.monotonic
+    return patch.object(
+        auth.time,
+        "monotonic",
+        side_effect=lambda: real_monotonic() + auth.SESSION_TTL_SECONDS + 1
+    )
+
+
+def test_login_state_round_trip():
+    """Test that a login state is accepted by the callback exactly once"""
+    state = client.get("/auth/login").json()["state"]
+    assert state in auth.sessions
+    
+    # Provider is down: the state is accepted, then the exchange fails
+    failing_http = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(503))
+    )
+    with provider_settings(), patch.object(auth, "_http", failing_http):
+        response = client.get(f"/auth/callback?code=abc&state={state}")
+        assert response.status_code == 500
+        assert state not in auth.sessions
+        
+        response = client.get(f"/auth/callback?code=abc&state={state}")
+        assert response.status_code == 400
+    print("✅ Login state round trip test passed")
+
+
+def test_expired_state_is_rejected():
+    """Test that an expired state is rejected even before cleanup removes it"""
+    state = client.get("/auth/login").json()["state"]
+    with after_session_ttl():
+        assert state in auth.sessions
+        response = client.get(f"/auth/callback?code=abc&state={state}")
+    assert response.status_code == 400
+    assert state not in auth.sessions
+    print("✅ Expired state test passed")
+
+
+def test_session_cleanup_with_limit():
+    """Test that cleanup pops only expired states, at most limit at a time"""
+    async def store_states():
+        for i in range(3):
+            await auth.store_session_state(f"state-{i}")
+    
+    with patch.object(auth, "sessions", {}), patch.object(auth, "_expiry_heap", []):
+        asyncio.run(store_states())
+        assert auth.cleanup_expired_sessions() == 0
+        assert len(auth.sessions) == 3
+        
+        with after_session_ttl():
+            assert auth.cleanup_expired_sessions(limit=2) == 2
+            assert len(auth.sessions) == 1
+            assert auth.cleanup_expired_sessions(limit=2) == 1
+            assert auth.sessions == {}
+            assert auth._expiry_heap == []
+    print("✅ Session cleanup test passed")
+
+
+def test_jwks_url_without_issuer_warns():
+    """Test that JWKS verification without an issuer is reported at startup"""
+    def issuer_warnings(**kwargs):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            Settings(oauth2_jwks_url="https://provider.test/jwks", **kwargs)
+        return [w for w in caught if "OAUTH2_ISSUER" in str(w.message)]
+    
+    assert len(issuer_warnings(oauth2_issuer="")) == 1
+    assert issuer_warnings(oauth2_issuer=PROVIDER_ISSUER) == []
+    print("✅ JWKS issuer configuration test passed")
+
+
+def test_clients_reopen_after_lifespan():
+    """Test that shared clients are recreated after an app shutdown"""
+    with TestClient(app):
+        first = auth.get_http_client()
+    assert first.is_closed
+    with TestClient(app):
+        second = auth.get_http_client()
+        assert second is not first
+        assert not second.is_closed
+    print("✅ Client reopen test passed")
+
+
+class FakeRedis:
+    """Minimal async stand-in for the Redis commands the session store uses"""
+    
+    def __init__(self, fail=False):
+        self.data = {}
+        self.fail = fail
+    
+    async def set(self, key, value, ex=None):
+        if self.fail:
+            raise RedisConnectionError("connection refused")
+        self.data[key] = (value, ex)
+    
+    async def delete(self, key):
+        if self.fail:
+            raise RedisConnectionError("connection refused")
+        return 1 if self.data.pop(key, None) is not None else 0
+
+
+def test_redis_session_store():
+    """Test that login states go to Redis with a TTL and are consumed once"""
+    fake = FakeRedis()
+    with patch.object(auth, "_redis", fake):
+        response = client.get("/auth/login")
+        assert response.status_code == 200
+        state = response.json()["state"]
+        assert fake.data[f"sess:{state}"] == ("pending", auth.SESSION_TTL_SECONDS)
+        assert state not in auth.sessions
+        
+        assert asyncio.run(auth.consume_session_state(state)) is True
+        assert asyncio.run(auth.consume_session_state(state)) is False
+    print("✅ Redis session store test passed")
+
+
+def test_redis_errors_return_503():
+    """Test that an unavailable Redis is reported as 503, not 500"""
+    with patch.object(auth, "_redis", FakeRedis(fail=True)):
+        response = client.get("/auth/login")
+        assert response.status_code == 503
+        response = client.get("/auth/callback?code=abc&state=xyz")
+        assert response.status_code == 503
+    print("✅ Redis error handling test passed")
+
+
 def test_logout_endpoint():
     """Test logout endpoint"""
     response = client.post("/auth/logout")
     assert response.status_code == 200
     data = response.json()
     assert "message" in data
+    assert "access_token=;" in response.headers["set-cookie"]
+    assert "Max-Age=0" in response.headers["set-cookie"]
     print("✅ Logout endpoint test passed")
 
 
@@ -77,10 +503,28 @@ if __name__ == "__main__":
     
     test_health_check()
     test_home_page()
+    test_home_page_respects_gzip_qvalue()
     test_login_endpoint()
     test_auth_status_not_authenticated()
     test_protected_route_requires_auth()
     test_me_endpoint_requires_auth()
+    test_me_endpoint_with_bearer_token()
+    test_verified_user_is_cached()
+    test_cached_user_expires_with_token()
+    test_jwks_keys_are_cached()
+    test_jwks_refresh_is_throttled_while_provider_down()
+    test_verify_provider_id_token()
+    test_callback_with_id_token()
+    test_callback_ignores_id_token_by_default()
+    test_callback_without_id_token()
+    test_callback_with_unverifiable_id_token()
+    test_login_state_round_trip()
+    test_expired_state_is_rejected()
+    test_session_cleanup_with_limit()
+    test_jwks_url_without_issuer_warns()
+    test_clients_reopen_after_lifespan()
+    test_redis_session_store()
+    test_redis_errors_return_503()
     test_logout_endpoint()
     
     print("\n✅ All tests passed!")